@@ -4,9 +4,16 @@ Audio Generator for SkillSwap Demo Video
 Uses AWS Polly to convert demo_script.txt to demo_audio.mp3
 """
 
-import boto3
+import hashlib
 import os
+import re
+import shutil
 import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import boto3
+from botocore.config import Config
 
 
 
@@ -21,6 +28,38 @@ VOICE_ID = 'Kendra'  # Change this to your preferred voice
 # Standard only: Ivy, Justin
 # ============================================
 
+# SSML tokens used when splitting the script into Polly-sized segments
+SECTION_MARKER = '[SECTION: '
+SECTION_MARKER_RE = re.compile(r'\[SECTION: [^\]]+\]\n?')
+SPEAK_OPEN = '<speak>'
+SPEAK_CLOSE = '</speak>'
+PROSODY_CLOSE = '</prosody>'
+
+# Chunk size for streaming audio between Polly, cache files and the output
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# Upper bound on segments synthesized at once; one connection per worker
+MAX_CONCURRENT_REQUESTS = 32
+
+# Shared by all synthesis worker threads: one pooled connection per worker
+# avoids waiting on connections, and keep-alive avoids re-handshakes.
+POLLY_CONFIG = Config(
+    max_pool_connections=MAX_CONCURRENT_REQUESTS,
+    tcp_keepalive=True,
+    retries={'max_attempts': 3, 'mode': 'standard'},
+    connect_timeout=5,
+    read_timeout=30,
+)
+
+# Polly error text meaning the voice has no neural engine at all, as opposed
+# to a neural-unsupported SSML feature in one particular segment
+VOICE_ENGINE_ERRORS = ('EngineNotSupported', 'does not support the selected engine')
+
+# Voices Polly rejected for the neural engine outright. Once a probe lands
+# here, later segments skip the failed neural attempt. SSML features that
+# neural rejects only make their own segment fall back and are not recorded.
+_NEURAL_UNSUPPORTED_VOICES = set()
+
 
 def read_script(path):
     """
@@ -36,14 +75,21 @@ def read_script(path):
         FileNotFoundError: If script file doesn't exist
         IOError: If script file cannot be read
     """
-    if not os.path.exists(path):
+    # A single stat both checks existence and sizes the read
+    try:
+        size = os.stat(path).st_size
+    except FileNotFoundError:
         raise FileNotFoundError(f"Script file not found: {path}")
     
+    if size == 0:
+        raise ValueError("Script file is empty")
+    
     try:
+        # UTF-8 never decodes to more characters than bytes, so one read suffices
         with open(path, 'r', encoding='utf-8') as f:
-            content = f.read()
+            content = f.read(size)
         
-        if not content.strip():
+        if content.isspace():
             raise ValueError("Script file is empty")
         
         return content
@@ -51,81 +97,178 @@ def read_script(path):
         raise IOError(f"Failed to read script file: {e}")
 
 
-def split_for_polly(text, max_chars=3000):
+def _speak_content(piece, in_speak, seen_speak):
     """
-    Split text into chunks that fit Polly's character limit.
-    Splits at section markers to maintain coherent segments.
-    Removes section markers and ensures single <speak> root per segment.
+    Keep only the parts of a script fragment that lie inside <speak> tags.
     
     Args:
-        text: Full script text
-        max_chars: Maximum characters per chunk (default: 3000)
+        piece: Script fragment (section markers already removed)
+        in_speak: True if the fragment starts inside a <speak> element
+        seen_speak: True if an earlier fragment already opened a <speak>
         
     Returns:
-        list[str]: List of text segments (each with single <speak> root)
+        tuple[str, bool, bool]: Kept content, and the updated in_speak and
+        seen_speak flags at the end of the fragment
     """
-    import re
-    
-    # Remove section markers - they're for organization, not for Polly
-    section_pattern = r'\[SECTION: [^\]]+\]\n?'
-    text_without_markers = re.sub(section_pattern, '', text)
-    
-    # Extract all content between <speak> tags
-    speak_pattern = r'<speak>(.*?)</speak>'
-    speak_contents = re.findall(speak_pattern, text_without_markers, re.DOTALL)
+    parts = []
+    pos = 0
+    while True:
+        if in_speak:
+            end = piece.find(SPEAK_CLOSE, pos)
+            if end == -1:
+                parts.append(piece[pos:])
+                break
+            parts.append(piece[pos:end])
+            pos = end + len(SPEAK_CLOSE)
+            in_speak = False
+        else:
+            start = piece.find(SPEAK_OPEN, pos)
+            if start == -1:
+                break
+            # Separate consecutive <speak> blocks like the original script does
+            if seen_speak:
+                parts.append('\n')
+            pos = start + len(SPEAK_OPEN)
+            in_speak = True
+            seen_speak = True
+    return ''.join(parts), in_speak, seen_speak
+
+
+def _build_segment(content_parts):
+    """
+    Turn accumulated prosody blocks into a Polly request body.
     
-    # Combine all content
-    combined_content = '\n'.join(speak_contents)
+    Segments without any markup or entities are sent as plain text, which
+    skips Polly's SSML parsing; everything else keeps its <speak> root.
     
-    # If combined content fits in one segment, return it
-    full_ssml = f'<speak>{combined_content}</speak>'
-    if len(full_ssml) <= max_chars:
-        return [full_ssml]
+    Args:
+        content_parts: list[str] - Blocks making up the segment
+        
+    Returns:
+        tuple[str, bool]: Segment text and whether it is SSML
+    """
+    content = ''.join(content_parts)
+    if '<' in content or '&' in content:
+        return SPEAK_OPEN + content + SPEAK_CLOSE, True
+    return content.strip(), False
+
+
+def split_for_polly(text, max_chars=3000):
+    """
+    Split text into chunks that fit Polly's character limit.
+    Splits at </prosody> boundaries to maintain coherent segments.
+    Removes section markers and ensures single <speak> root per SSML segment.
     
-    # Need to split - do it at prosody boundaries
-    prosody_blocks = re.split(r'(</prosody>)', combined_content)
+    The script is scanned once, left to right, packing prosody blocks into
+    the current segment until the next one would exceed max_chars.
     
+    Args:
+        text: Full script text
+        max_chars: Maximum characters per chunk (default: 3000)
+        
+    Returns:
+        list[tuple[str, bool]]: List of (segment, is_ssml) pairs; SSML
+        segments have a single <speak> root, plain ones are raw text
+    """
+    wrapper_len = len(SPEAK_OPEN) + len(SPEAK_CLOSE)
     segments = []
-    current_content = ""
+    current_content = []
+    current_len = 0
+    in_speak = False
+    seen_speak = False
     
-    for i in range(0, len(prosody_blocks), 2):
-        if i >= len(prosody_blocks):
-            break
-            
-        block = prosody_blocks[i]
-        closing_tag = prosody_blocks[i + 1] if i + 1 < len(prosody_blocks) else ""
-        full_block = block + closing_tag
+    pieces = text.split(PROSODY_CLOSE)
+    last_index = len(pieces) - 1
+    for index, piece in enumerate(pieces):
+        # Section markers are for organization, not for Polly
+        if SECTION_MARKER in piece:
+            piece = SECTION_MARKER_RE.sub('', piece)
+        block, in_speak, seen_speak = _speak_content(piece, in_speak, seen_speak)
+        
+        # The split consumed a closing tag; restore it if it was inside <speak>
+        if index < last_index and in_speak:
+            block += PROSODY_CLOSE
         
-        if not full_block.strip():
+        if not block.strip():
             continue
         
-        # Check if adding this block would exceed limit (accounting for <speak> wrapper)
-        test_segment = f'<speak>{current_content}{full_block}</speak>'
-        if current_content and len(test_segment) > max_chars:
-            # Save current segment
-            segments.append(f'<speak>{current_content}</speak>')
-            current_content = full_block
-        else:
-            current_content += full_block
+        # Flush if adding this block would exceed limit (accounting for <speak> wrapper)
+        if current_content and current_len + len(block) + wrapper_len > max_chars:
+            segments.append(_build_segment(current_content))
+            current_content = []
+            current_len = 0
+        
+        current_content.append(block)
+        current_len += len(block)
     
     # Add final segment
-    if current_content.strip():
-        segments.append(f'<speak>{current_content}</speak>')
+    if current_content:
+        segments.append(_build_segment(current_content))
+    
+    return segments if segments else [(SPEAK_OPEN + SPEAK_CLOSE, True)]
+
+
+def _request_speech(polly_client, engine, text, text_type):
+    """
+    Issue a single Polly synthesize_speech request.
     
-    return segments if segments else [full_ssml]
+    Args:
+        polly_client: boto3 Polly client instance
+        engine: Polly engine ('neural' or 'standard')
+        text: Text or SSML to synthesize
+        text_type: 'ssml' or 'text'
+        
+    Returns:
+        dict: Polly response
+    """
+    return polly_client.synthesize_speech(
+        Engine=engine,
+        LanguageCode='en-US',
+        OutputFormat='mp3',
+        Text=text,
+        TextType=text_type,
+        VoiceId=VOICE_ID
+    )
 
 
-def synthesize_speech(polly_client, text, is_ssml):
+def _probe_engine(polly_client, text, text_type):
     """
-    Call Polly API to generate audio bytes.
+    Synthesize with the neural engine, falling back to standard if unsupported.
+    
+    Args:
+        polly_client: boto3 Polly client instance
+        text: Text or SSML to synthesize
+        text_type: 'ssml' or 'text'
+        
+    Returns:
+        tuple[dict, str]: Polly response and the engine that produced it
+    """
+    # Try neural engine first (better quality but limited SSML support)
+    try:
+        return _request_speech(polly_client, 'neural', text, text_type), 'neural'
+    except Exception as neural_error:
+        # If neural fails, try standard engine
+        error_msg = str(neural_error)
+        if any(marker in error_msg for marker in VOICE_ENGINE_ERRORS):
+            # The voice itself lacks neural; skip the attempt from now on
+            _NEURAL_UNSUPPORTED_VOICES.add(VOICE_ID)
+        elif not ('Unsupported' in error_msg or 'Neural' in error_msg or 'does not support' in error_msg):
+            raise
+        return _request_speech(polly_client, 'standard', text, text_type), 'standard'
+
+
+def synthesize_speech(polly_client, text, is_ssml, out_fp):
+    """
+    Call Polly API and stream the generated audio into a file.
     
     Args:
         polly_client: boto3 Polly client instance
         text: Text or SSML to synthesize
         is_ssml: True if text contains SSML markup, False for plain text
+        out_fp: Writable binary file object receiving the MP3 data
         
     Returns:
-        bytes: MP3 audio data
+        str: Engine that produced the audio ('neural' or 'standard')
         
     Raises:
         Exception: If Polly API call fails
@@ -134,35 +277,16 @@ def synthesize_speech(polly_client, text, is_ssml):
         # Determine text type based on SSML flag
         text_type = 'ssml' if is_ssml else 'text'
         
-        # Try neural engine first (better quality but limited SSML support)
-        try:
-            response = polly_client.synthesize_speech(
-                Engine='neural',
-                LanguageCode='en-US',
-                OutputFormat='mp3',
-                Text=text,
-                TextType=text_type,
-                VoiceId=VOICE_ID
-            )
-        except Exception as neural_error:
-            # If neural fails, try standard engine
-            error_msg = str(neural_error)
-            if 'Unsupported' in error_msg or 'Neural' in error_msg or 'does not support' in error_msg:
-                response = polly_client.synthesize_speech(
-                    Engine='standard',
-                    LanguageCode='en-US',
-                    OutputFormat='mp3',
-                    Text=text,
-                    TextType=text_type,
-                    VoiceId=VOICE_ID
-                )
-            else:
-                raise neural_error
+        if VOICE_ID in _NEURAL_UNSUPPORTED_VOICES:
+            engine = 'standard'
+            response = _request_speech(polly_client, engine, text, text_type)
+        else:
+            response, engine = _probe_engine(polly_client, text, text_type)
         
-        # Extract audio stream from response
+        # Copy audio stream from response without buffering it whole
         if 'AudioStream' in response:
-            audio_bytes = response['AudioStream'].read()
-            return audio_bytes
+            shutil.copyfileobj(response['AudioStream'], out_fp, STREAM_CHUNK_SIZE)
+            return engine
         else:
             raise Exception("No audio stream in Polly response")
             
@@ -170,19 +294,67 @@ def synthesize_speech(polly_client, text, is_ssml):
         raise Exception(f"Polly synthesis failed: {e}")
 
 
-def concatenate_audio(segments):
+def _cache_path(cache_dir, text, is_ssml, engine):
+    """
+    Build the on-disk cache location for a synthesized segment.
+    
+    Args:
+        cache_dir: Directory holding cached MP3 segments
+        text: Text or SSML to synthesize
+        is_ssml: True if text contains SSML markup, False for plain text
+        engine: Polly engine that produced the audio
+        
+    Returns:
+        str: Path of the cached MP3 for this voice/engine/text combination
+    """
+    text_type = 'ssml' if is_ssml else 'text'
+    key = f"{VOICE_ID}|{engine}|{text_type}|{text}"
+    digest = hashlib.sha256(key.encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir, f"{digest}.mp3")
+
+
+def synthesize_cached(polly_client, text, is_ssml, cache_dir):
     """
-    Combine multiple MP3 segments into one.
+    Ensure a segment's audio is in the cache, synthesizing it if missing.
+    
+    Unchanged segments are served from cache_dir instead of calling Polly,
+    so re-running after editing one section only synthesizes that section.
+    Entries are keyed by the engine that produced them, and lookups try the
+    engines in the same order synthesis would.
     
     Args:
-        segments: list[bytes] - List of MP3 audio byte segments
+        polly_client: boto3 Polly client instance
+        text: Text or SSML to synthesize
+        is_ssml: True if text contains SSML markup, False for plain text
+        cache_dir: Directory holding cached MP3 segments
         
     Returns:
-        bytes: Combined MP3 audio data
+        str: Path of the cached MP3 file for this segment
     """
-    # For MP3 files, simple concatenation works because MP3 is a stream format
-    # Each frame is independent, so we can just join the byte streams
-    return b''.join(segments)
+    if VOICE_ID in _NEURAL_UNSUPPORTED_VOICES:
+        engines = ('standard',)
+    else:
+        engines = ('neural', 'standard')
+    for engine in engines:
+        path = _cache_path(cache_dir, text, is_ssml, engine)
+        if os.path.exists(path):
+            return path
+    
+    # Write atomically so an interrupted run never leaves a truncated entry
+    os.makedirs(cache_dir, exist_ok=True)
+    # A unique temp name keeps concurrent writers of the same key apart
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            engine = synthesize_speech(polly_client, text, is_ssml, f)
+        path = _cache_path(cache_dir, text, is_ssml, engine)
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    
+    return path
 
 
 def main():
@@ -194,6 +366,7 @@ def main():
     script_dir = os.path.dirname(os.path.abspath(__file__))
     script_path = os.path.join(script_dir, 'demo_script.txt')
     output_path = os.path.join(script_dir, 'demo_audio.mp3')
+    cache_dir = os.path.join(script_dir, '.polly_cache')
     
     try:
         # Step 1: Read script
@@ -201,20 +374,18 @@ def main():
         script_content = read_script(script_path)
         print(f"   ✓ Script loaded ({len(script_content)} characters)")
         
-        # Step 2: Check if script contains SSML
-        is_ssml = '<speak>' in script_content
-        print(f"   ✓ SSML detected: {is_ssml}")
-        
-        # Step 3: Split script if needed
+        # Step 2: Split script if needed, detecting SSML per segment
         print("\n2. Splitting script for Polly...")
         segments = split_for_polly(script_content, max_chars=3000)
         print(f"   ✓ Split into {len(segments)} segment(s)")
+        ssml_count = sum(1 for _, seg_is_ssml in segments if seg_is_ssml)
+        print(f"   ✓ SSML segments: {ssml_count}/{len(segments)}")
         
         
-        # Step 4: Initialize Polly client
+        # Step 3: Initialize Polly client
         print("\n3. Connecting to AWS Polly...")
         try:
-            polly_client = boto3.client('polly')
+            polly_client = boto3.client('polly', config=POLLY_CONFIG)
             print("   ✓ Connected to AWS Polly")
         except Exception as e:
             print(f"   ✗ Failed to connect to AWS Polly")
@@ -225,30 +396,62 @@ def main():
             print("  3. Your AWS account has Polly access")
             sys.exit(1)
         
-        # Step 5: Synthesize each segment
+        # Step 4: Synthesize segments concurrently into the cache
+        # Each Polly call is an independent network round-trip, so put every
+        # segment in flight at once and report the first failure as soon as it
+        # happens, whatever its position in the script. Identical segments
+        # share a cache entry, so each distinct one is synthesized only once.
         print("\n4. Synthesizing speech...")
-        audio_segments = []
+        segment_indices = {}
         for i, segment in enumerate(segments, 1):
-            print(f"   Segment {i}/{len(segments)}...", end=' ')
-            try:
-                audio_bytes = synthesize_speech(polly_client, segment, is_ssml)
-                audio_segments.append(audio_bytes)
-                print(f"✓ ({len(audio_bytes)} bytes)")
-            except Exception as e:
-                print(f"✗ Failed")
-                print(f"\nError synthesizing segment {i}: {e}")
-                sys.exit(1)
+            segment_indices.setdefault(segment, []).append(i)
         
-        # Step 6: Concatenate segments
-        print("\n5. Concatenating audio segments...")
-        final_audio = concatenate_audio(audio_segments)
-        print(f"   ✓ Combined audio ({len(final_audio)} bytes)")
+        workers = min(MAX_CONCURRENT_REQUESTS, len(segment_indices))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(
+                    synthesize_cached, polly_client, segment, seg_is_ssml, cache_dir
+                ): indices
+                for (segment, seg_is_ssml), indices in segment_indices.items()
+            }
+            segment_paths = [None] * len(segments)
+            for future in as_completed(futures):
+                indices = futures[future]
+                try:
+                    path = future.result()
+                except Exception as e:
+                    print(f"   Segment {indices[0]}/{len(segments)} ✗ Failed")
+                    print(f"\nError synthesizing segment {indices[0]}: {e}")
+                    # Drop queued segments; requests already in flight still
+                    # finish before the pool's context manager lets us exit
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    sys.exit(1)
+                size = os.path.getsize(path)
+                for i in indices:
+                    segment_paths[i - 1] = path
+                    print(f"   Segment {i}/{len(segments)} ✓ ({size} bytes)")
         
-        # Step 7: Save to file
-        print(f"\n6. Saving to {output_path}...")
-        with open(output_path, 'wb') as f:
-            f.write(final_audio)
-        print(f"   ✓ Audio saved successfully")
+        # Step 5: Save to file
+        # MP3 is a stream format, so segments can simply be written back to
+        # back in script order. The output is written to a uniquely named
+        # temp file so a failed write never clobbers the previous
+        # demo_audio.mp3 and concurrent runs never share a temp file.
+        print(f"\n5. Saving to {output_path}...")
+        fd, tmp_output_path = tempfile.mkstemp(dir=script_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                for path in segment_paths:
+                    with open(path, 'rb') as segment_fp:
+                        shutil.copyfileobj(segment_fp, out, STREAM_CHUNK_SIZE)
+                total_bytes = out.tell()
+            # mkstemp creates owner-only files; keep the usual MP3 permissions
+            os.chmod(tmp_output_path, 0o644)
+            os.replace(tmp_output_path, output_path)
+        except Exception:
+            if os.path.exists(tmp_output_path):
+                os.remove(tmp_output_path)
+            raise
+        print(f"   ✓ Audio saved successfully ({total_bytes} bytes)")
         
         print("\n" + "=" * 50)
         print("✓ Demo audio generation complete!")